@@ -1,25 +1,36 @@
-import asyncio
-import logging
-import pandas as pd
-from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
-from aiogram.filters import Command, StateFilter
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import (KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup,
-                           InlineKeyboardButton, Message, ReplyKeyboardRemove, BotCommand)
-import aiosqlite
-from dotenv import load_dotenv
-import os
-from datetime import datetime
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from typing import Any, Awaitable, Callable, Dict
-from gigachat import GigaChat
-from langchain.llms import GigaChat as LangChainGigaChat
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
+import time
+
+# Момент начала импорта модулей — для профилирования запуска (STARTUP_PROFILE=1).
+# Засекаем до остальных импортов, чтобы их время попало в профиль, поэтому они помечены noqa: E402
+STARTUP_STARTED = time.perf_counter()
+
+import asyncio  # noqa: E402
+import csv  # noqa: E402
+import contextvars  # noqa: E402
+import html  # noqa: E402
+import itertools  # noqa: E402
+import logging  # noqa: E402
+import re  # noqa: E402
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware  # noqa: E402
+from aiogram.filters import Command, StateFilter  # noqa: E402
+from aiogram.client.default import DefaultBotProperties  # noqa: E402
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware  # noqa: E402
+from aiogram.enums import ParseMode  # noqa: E402
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter  # noqa: E402
+from aiogram.fsm.context import FSMContext  # noqa: E402
+from aiogram.fsm.state import State, StatesGroup  # noqa: E402
+from aiogram.fsm.storage.memory import MemoryStorage  # noqa: E402
+from aiogram.types import (KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup,  # noqa: E402
+                           InlineKeyboardButton, Message, ReplyKeyboardRemove, BotCommand,
+                           CallbackQuery)
+import aiosqlite  # noqa: E402
+from dotenv import load_dotenv  # noqa: E402
+import os  # noqa: E402
+from collections import Counter, OrderedDict  # noqa: E402
+from contextlib import contextmanager  # noqa: E402
+from datetime import datetime  # noqa: E402
+from apscheduler.schedulers.asyncio import AsyncIOScheduler  # noqa: E402
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple  # noqa: E402
 
 
 # Загружаем переменные окружения
@@ -29,17 +40,154 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+# Профилирование запуска: время импорта и инициализации по этапам
+class StartupProfiler:
+    def __init__(self, enabled: bool, started: float):
+        self.enabled = enabled
+        self.started = started
+        self.last = started
+        self.stages = []
+        self.polling_started = None
+        self.first_update_seen = False
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled:
+            return
+        lines = [f"  {stage}: {duration * 1000:.0f} мс" for stage, duration in self.stages]
+        total = time.perf_counter() - self.started
+        logger.info("Профиль запуска:\n" + "\n".join(lines) + f"\n  всего: {total * 1000:.0f} мс")
+
+    async def on_startup(self):
+        # Вызывается диспетчером непосредственно перед началом опроса обновлений
+        self.mark("запуск диспетчера")
+        self.polling_started = time.perf_counter()
+        self.report()
+
+    async def first_update_middleware(self, handler, event, data):
+        # Время до первого обновления зависит от пользователей, поэтому в профиль запуска не входит
+        if not self.first_update_seen:
+            self.first_update_seen = True
+            latency = time.perf_counter() - self.polling_started
+            logger.info(f"Первое обновление получено через {latency * 1000:.0f} мс после начала опроса")
+        return await handler(event, data)
+
+
+startup_profiler = StartupProfiler(os.getenv('STARTUP_PROFILE') == '1', STARTUP_STARTED)
+startup_profiler.mark("импорт модулей")
+
 # Инициализация бота и диспетчера
 API_TOKEN = os.getenv('API_TOKEN')
 GIGACHAT_CREDENTIALS = os.getenv('GIGACHAT_CREDENTIALS')
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv('ADMIN_IDS', '').split(',') if admin_id.strip()}
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-gigachat = GigaChat(credentials=GIGACHAT_CREDENTIALS, verify_ssl_certs=False)
 
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 
 # Инициализация планировщика
 scheduler = AsyncIOScheduler()
+startup_profiler.mark("создание бота и диспетчера")
+
+
+# GigaChat: langchain и gigachat импортируются только при первом обращении,
+# так как их загрузка занимает несколько секунд и задерживает запуск бота
+llm_loading: Optional[asyncio.Future] = None
+
+
+def build_llm():
+    # Выполняется в отдельном потоке: и импорт, и создание клиента (он импортирует SDK gigachat)
+    # заняли бы цикл событий на несколько секунд. LLMChain и PromptTemplate загружаем заранее,
+    # чтобы их импорт в функциях анализа брал модули из кэша
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+    from langchain_community.llms import GigaChat as LangChainGigaChat
+    return LangChainGigaChat(credentials=GIGACHAT_CREDENTIALS, verify_ssl_certs=False)
+
+
+async def get_llm():
+    # Все одновременные обращения ждут одну и ту же загрузку; после ошибки загрузка повторяется
+    global llm_loading
+    failed = llm_loading is not None and llm_loading.done() and (
+        llm_loading.cancelled() or llm_loading.exception() is not None
+    )
+    if llm_loading is None or failed:
+        llm_loading = asyncio.ensure_future(asyncio.to_thread(build_llm))
+    return await asyncio.shield(llm_loading)
+
+
+async def warm_up_llm():
+    # Загружаем модули в отдельном потоке параллельно с запуском опроса обновлений:
+    # цикл событий при этом не блокируется
+    started = time.perf_counter()
+    try:
+        await get_llm()
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке модулей GigaChat: {e}")
+        return
+    if startup_profiler.enabled:
+        logger.info(f"Модули GigaChat загружены в фоне за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+
+# Одинаковые одновременные запросы к GigaChat выполняются один раз,
+# остальные вызовы с тем же ключом (пользователь, операция, входные данные) ждут общий результат
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[Tuple, asyncio.Task] = {}
+        self.coalesced = Counter()
+
+    async def run(self, key: Tuple, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        task = self.calls.get(key)
+        shared = task is not None
+        if shared:
+            operation = key[1]
+            self.coalesced[operation] += 1
+            logger.info(
+                f"Повторный запрос '{operation}' пользователя {key[0]} объединен с выполняющимся "
+                f"(всего объединено: {self.coalesced[operation]})"
+            )
+        else:
+            task = asyncio.ensure_future(factory())
+            self.calls[key] = task
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+
+        # shield: отмена одного из ожидающих не должна прерывать запрос для остальных
+        return await asyncio.shield(task), shared
+
+
+llm_flight = SingleFlight()
+
+
+# Ключи уже обработанных событий, чтобы повторная доставка не выполнялась дважды
+class IdempotencyCache:
+    def __init__(self, ttl: float = 3600, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.keys: OrderedDict = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, key) -> bool:
+        now = time.monotonic()
+        # Ключи добавляются по порядку, поэтому устаревшие всегда в начале
+        while self.keys and (len(self.keys) >= self.max_size or next(iter(self.keys.values())) < now - self.ttl):
+            self.keys.popitem(last=False)
+
+        if key in self.keys:
+            self.duplicates += 1
+            return True
+        self.keys[key] = now
+        return False
+
+    def forget(self, key):
+        self.keys.pop(key, None)
+
+
+processed_ratings = IdempotencyCache()
 
 
 # FSM
@@ -132,6 +280,313 @@ class LoggingMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+# Анти-флуд: token bucket на пару (пользователь, действие)
+def parse_limit(value: str) -> Tuple[float, int]:
+    # Формат "<событий>/<секунд>", например "2/60" — не больше 2 событий за минуту
+    events, seconds = value.split('/')
+    burst = int(events)
+    return burst / float(seconds), burst
+
+
+class MemoryThrottleBackend:
+    # Сколько корзин держим в памяти, прежде чем удалять давно неактивные
+    MAX_BUCKETS = 10000
+
+    def __init__(self):
+        # Порядок ключей — от давно не использованных к недавним
+        self.buckets: OrderedDict = OrderedDict()
+
+    async def consume(self, key: str, rate: float, burst: int) -> bool:
+        now = time.monotonic()
+        tokens, updated, _, _ = self.buckets.get(key, (burst, now, rate, burst))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now, rate, burst)
+        self.buckets.move_to_end(key)
+
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.prune(now)
+        return allowed
+
+    def prune(self, now: float):
+        # Удалять можно только корзину, которая уже успела бы полностью наполниться:
+        # она ничем не отличается от новой. Неполную корзину удалять нельзя — иначе лимит сбросится
+        while len(self.buckets) > self.MAX_BUCKETS:
+            key, (tokens, updated, rate, burst) = next(iter(self.buckets.items()))
+            if tokens + (now - updated) * rate < burst:
+                break
+            del self.buckets[key]
+
+
+class RedisThrottleBackend:
+    # Атомарный token bucket на стороне Redis, общий для всех экземпляров бота
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local burst = tonumber(ARGV[2])
+        local t = redis.call('TIME')
+        local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+        local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(data[1]) or burst
+        local ts = tonumber(data[2]) or now
+        tokens = math.min(burst, tokens + (now - ts) * rate)
+        local allowed = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return allowed
+    """
+
+    def __init__(self, url: str):
+        # redis не входит в обязательные зависимости
+        from redis.asyncio import Redis
+        self.redis = Redis.from_url(url)
+        self.script = self.redis.register_script(self.SCRIPT)
+
+    async def consume(self, key: str, rate: float, burst: int) -> bool:
+        allowed = await self.script(keys=[f"throttle:{key}"], args=[rate, burst])
+        return bool(allowed)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Не чаще одного предупреждения "не так быстро" за этот период (в секундах)
+    WARNING_PERIOD = 10
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]], backend=None):
+        self.limits = limits
+        self.backend = backend or MemoryThrottleBackend()
+        self.dropped = Counter()
+        # Время последнего предупреждения; ключи упорядочены по этому времени
+        self.warned: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def get_action(event) -> str:
+        if isinstance(event, CallbackQuery):
+            return event.data.split(':', 1)[0] if event.data else 'default'
+        if isinstance(event, Message) and event.text == "Анализ динамики":
+            return 'analyze'
+        return 'default'
+
+    async def __call__(
+            self,
+            handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+            event: Any,
+            data: Dict[str, Any]
+    ) -> Any:
+        user = getattr(event, 'from_user', None)
+        if user is None:
+            return await handler(event, data)
+
+        action = self.get_action(event)
+        if action not in self.limits:
+            action = 'default'
+        rate, burst = self.limits[action]
+        key = f"{user.id}:{action}"
+
+        try:
+            allowed = await self.backend.consume(key, rate, burst)
+        except Exception as e:
+            # Недоступность хранилища лимитов не должна останавливать бота
+            logger.error(f"Ошибка при проверке лимита запросов: {e}")
+            allowed = True
+
+        if allowed:
+            return await handler(event, data)
+
+        self.dropped[action] += 1
+        logger.warning(
+            f"Пользователь {user.id} превысил лимит для действия '{action}' "
+            f"(отброшено событий: {self.dropped[action]})"
+        )
+        await self.warn(event, key)
+
+    async def warn(self, event, key: str):
+        text = "Слишком много запросов. Пожалуйста, подождите немного и попробуйте снова."
+        if isinstance(event, CallbackQuery):
+            await event.answer(text)
+            return
+
+        now = time.monotonic()
+        if now - self.warned.get(key, 0) < self.WARNING_PERIOD:
+            return
+        while self.warned and now - next(iter(self.warned.values())) >= self.WARNING_PERIOD:
+            self.warned.popitem(last=False)
+        self.warned[key] = now
+        self.warned.move_to_end(key)
+        await event.answer(text)
+
+
+def create_throttling_middleware() -> ThrottlingMiddleware:
+    limits = {
+        'default': parse_limit(os.getenv('THROTTLE_DEFAULT_LIMIT', '5/5')),
+        'rate': parse_limit(os.getenv('THROTTLE_RATE_LIMIT', '10/5')),
+        'analyze': parse_limit(os.getenv('THROTTLE_ANALYZE_LIMIT', '2/60')),
+    }
+    redis_url = os.getenv('THROTTLE_REDIS_URL')
+    backend = RedisThrottleBackend(redis_url) if redis_url else None
+    return ThrottlingMiddleware(limits, backend)
+
+
+# Исходящие сообщения: очередь с приоритетами и общим ограничением скорости
+LANE_INTERACTIVE = 0
+LANE_ANALYSIS = 1
+LANE_REMINDER = 2
+LANE_NAMES = {
+    LANE_INTERACTIVE: 'interactive',
+    LANE_ANALYSIS: 'analysis',
+    LANE_REMINDER: 'reminder',
+}
+
+# Приоритет отправки для текущей задачи; по умолчанию — ответ на действие пользователя
+outbound_lane = contextvars.ContextVar('outbound_lane', default=LANE_INTERACTIVE)
+
+
+@contextmanager
+def send_lane(lane: int):
+    token = outbound_lane.set(lane)
+    try:
+        yield
+    finally:
+        outbound_lane.reset(token)
+
+
+class OutboundDispatcher(BaseRequestMiddleware):
+    # Сколько записей о чатах держим в памяти, прежде чем удалить устаревшие
+    MAX_CHATS = 10000
+    # Если за это время (в секундах) ограничение получили столько разных чатов,
+    # считаем, что Telegram ограничил бота целиком, и ставим на паузу всю очередь
+    GLOBAL_PAUSE_WINDOW = 10
+    GLOBAL_PAUSE_CHATS = 3
+
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1, chat_burst: int = 3,
+                 max_retries: int = 3):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        self.chat_tolerance = (chat_burst - 1) * self.chat_interval
+        self.max_retries = max_retries
+
+        self.queue: Optional[asyncio.PriorityQueue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.sequence = itertools.count()
+        # Теоретическое время следующей отправки в чат (алгоритм GCRA)
+        self.chat_tat: Dict[int, float] = {}
+        self.next_send = 0.0
+        self.paused_until = 0.0
+        # Чаты, недавно получившие ответ "Too Many Requests", по времени ответа
+        self.limited_chats: OrderedDict = OrderedDict()
+        # Для каждого приоритета: количество, суммарное и максимальное время ожидания
+        self.wait_stats = {lane: [0, 0.0, 0.0] for lane in LANE_NAMES}
+
+    async def __call__(self, make_request, bot: Bot, method):
+        # Ограничиваем только методы, адресованные конкретному чату (getUpdates и т.п. идут напрямую)
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        lane = outbound_lane.get()
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, lane)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(
+                    f"Telegram ограничил частоту отправки, пауза {e.retry_after} с "
+                    f"(чат {chat_id}, попытка {attempt + 1})"
+                )
+                self.delay_after_limit(chat_id, e.retry_after)
+
+    def delay_after_limit(self, chat_id, retry_after: float):
+        now = time.monotonic()
+        # Откладываем только этот чат, чтобы ограничение одного напоминания не задерживало остальных.
+        # Запас chat_tolerance нужен, чтобы GCRA не пропустил сообщение раньше retry_after
+        self.chat_tat[chat_id] = max(self.chat_tat.get(chat_id, now), now + retry_after + self.chat_tolerance)
+
+        self.limited_chats.pop(chat_id, None)
+        self.limited_chats[chat_id] = now
+        while self.limited_chats and next(iter(self.limited_chats.values())) < now - self.GLOBAL_PAUSE_WINDOW:
+            self.limited_chats.popitem(last=False)
+
+        if len(self.limited_chats) >= self.GLOBAL_PAUSE_CHATS:
+            logger.warning(f"Ограничение получили {len(self.limited_chats)} чатов, пауза всей очереди {retry_after} с")
+            self.paused_until = max(self.paused_until, now + retry_after)
+
+    async def acquire(self, chat_id, lane: int):
+        now = time.monotonic()
+
+        # Ограничение по чату ждем до постановки в общую очередь, чтобы не блокировать другие чаты
+        tat = max(self.chat_tat.get(chat_id, now), now)
+        self.chat_tat[chat_id] = tat + self.chat_interval
+        if len(self.chat_tat) > self.MAX_CHATS:
+            self.chat_tat = {chat: t for chat, t in self.chat_tat.items() if t > now}
+        delay = tat - self.chat_tolerance - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # В статистику идет только ожидание в общей очереди, без паузы по лимиту чата
+        self.ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        enqueued = time.monotonic()
+        await self.queue.put((lane, next(self.sequence), future))
+        await future
+
+        waited = time.monotonic() - enqueued
+        stats = self.wait_stats[lane]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    def ensure_worker(self):
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            delay = max(self.paused_until, self.next_send) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            item = await self.queue.get()
+            lane, _, future = item
+            # Отправитель мог быть отменен, пока ждал своей очереди
+            if future.done():
+                continue
+            # Пауза могла начаться, пока очередь была пуста
+            if self.paused_until > time.monotonic():
+                self.queue.put_nowait(item)
+                continue
+
+            self.next_send = time.monotonic() + self.global_interval
+            future.set_result(None)
+
+    async def log_stats(self):
+        # Корутина, чтобы планировщик выполнял ее в цикле событий, а не в отдельном потоке
+        queued = self.queue.qsize() if self.queue else 0
+        for lane, (count, total, longest) in self.wait_stats.items():
+            if count:
+                logger.info(
+                    f"Исходящие [{LANE_NAMES[lane]}]: отправлено {count}, "
+                    f"среднее ожидание {total / count:.2f} с, максимальное {longest:.2f} с"
+                )
+        logger.info(f"Исходящие: в очереди {queued} сообщений")
+        self.wait_stats = {lane: [0, 0.0, 0.0] for lane in LANE_NAMES}
+
+
+outbound = OutboundDispatcher(
+    global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', '25')),
+    chat_rate=float(os.getenv('OUTBOUND_CHAT_RATE', '1')),
+    chat_burst=int(os.getenv('OUTBOUND_CHAT_BURST', '3')),
+)
+
+
 # Клавиатуры
 main_menu = ReplyKeyboardMarkup(
     keyboard=[
@@ -173,12 +628,17 @@ user_responses = {}
 
 # Загрузка вопросов
 try:
-    questions_df = pd.read_csv('questions.csv')
-    TOTAL_QUESTIONS = len(questions_df)
+    with open('questions.csv', encoding='utf-8', newline='') as f:
+        questions = [
+            {'number': int(row['number']), 'positive': row['positive'], 'negative': row['negative']}
+            for row in csv.DictReader(f)
+        ]
+    TOTAL_QUESTIONS = len(questions)
 except Exception as e:
     logger.error(f"Ошибка при загрузке CSV файла: {e}")
-    questions_df = None
+    questions = None
     TOTAL_QUESTIONS = 0
+startup_profiler.mark("загрузка вопросов")
 
 # Функции баз данных
 async def create_user_database():
@@ -194,6 +654,8 @@ async def create_user_database():
 
 async def create_feedback_database():
     async with aiosqlite.connect('feedback.db') as db:
+        # WAL позволяет искать по отзывам, пока идет запись новых
+        await db.execute("PRAGMA journal_mode=WAL")
         await db.execute(
             """CREATE TABLE IF NOT EXISTS feedback (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -202,8 +664,186 @@ async def create_feedback_database():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )"""
         )
+
+        # Индекс, триггеры и первичное заполнение создаются в одной транзакции
+        await db.execute("BEGIN")
+
+        # Полнотекстовый индекс по тексту отзывов. unicode61 приводит кириллицу к нижнему регистру,
+        # "ё" заменяем на "е" сами. Префиксный индекс по 4 символам соответствует длине основ,
+        # которые чаще всего строит build_feedback_query; остальные префиксы ищутся без него
+        await db.execute(
+            """CREATE VIRTUAL TABLE IF NOT EXISTS feedback_fts USING fts5(
+                feedback,
+                content='feedback',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='4'
+            )"""
+        )
+        await db.execute(
+            """CREATE TRIGGER IF NOT EXISTS feedback_fts_insert AFTER INSERT ON feedback BEGIN
+                INSERT INTO feedback_fts (rowid, feedback)
+                VALUES (new.id, replace(replace(new.feedback, 'ё', 'е'), 'Ё', 'Е'));
+            END"""
+        )
+        await db.execute(
+            """CREATE TRIGGER IF NOT EXISTS feedback_fts_delete AFTER DELETE ON feedback BEGIN
+                INSERT INTO feedback_fts (feedback_fts, rowid, feedback)
+                VALUES ('delete', old.id, replace(replace(old.feedback, 'ё', 'е'), 'Ё', 'Е'));
+            END"""
+        )
+        await db.execute(
+            """CREATE TRIGGER IF NOT EXISTS feedback_fts_update AFTER UPDATE ON feedback BEGIN
+                INSERT INTO feedback_fts (feedback_fts, rowid, feedback)
+                VALUES ('delete', old.id, replace(replace(old.feedback, 'ё', 'е'), 'Ё', 'Е'));
+                INSERT INTO feedback_fts (rowid, feedback)
+                VALUES (new.id, replace(replace(new.feedback, 'ё', 'е'), 'Ё', 'Е'));
+            END"""
+        )
+
+        # Индексируем отзывы, сохраненные до появления полнотекстового поиска.
+        # Проверяем служебную таблицу индекса: SELECT из самой feedback_fts читал бы таблицу feedback
+        async with db.execute("SELECT 1 FROM feedback_fts_docsize LIMIT 1") as cursor:
+            index_empty = await cursor.fetchone() is None
+        if index_empty:
+            await db.execute(
+                """INSERT INTO feedback_fts (rowid, feedback)
+                SELECT id, replace(replace(feedback, 'ё', 'е'), 'Ё', 'Е') FROM feedback"""
+            )
         await db.commit()
 
+
+# Пакетная запись отзывов: одно соединение и одна транзакция на все накопившиеся отзывы
+class FeedbackWriter:
+    def __init__(self, path: str, batch_size: int = 500):
+        self.path = path
+        self.batch_size = batch_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    async def submit(self, user_id: int, feedback_text: str):
+        if self.task is None or self.task.done():
+            raise RuntimeError("Запись отзывов не запущена")
+
+        # Ждем фактической записи, чтобы пользователь узнал об ошибке сохранения
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((user_id, feedback_text, future))
+        await future
+
+    async def close(self):
+        if self.task is None:
+            return
+        if not self.task.done():
+            await self.queue.put(None)
+        try:
+            await self.task
+        except Exception:
+            # Ошибка уже записана в лог в run
+            pass
+        self.task = None
+
+    async def run(self):
+        batch = []
+        try:
+            async with aiosqlite.connect(self.path) as db:
+                stopping = False
+                while not stopping:
+                    item = await self.queue.get()
+                    if item is None:
+                        break
+
+                    # Забираем всё, что накопилось, пока выполнялась предыдущая запись
+                    batch = [item]
+                    while len(batch) < self.batch_size and not self.queue.empty():
+                        item = self.queue.get_nowait()
+                        if item is None:
+                            stopping = True
+                            break
+                        batch.append(item)
+
+                    try:
+                        await db.executemany(
+                            "INSERT INTO feedback (user_id, feedback) VALUES (?, ?)",
+                            [(user_id, feedback_text) for user_id, feedback_text, _ in batch]
+                        )
+                        await db.commit()
+                    except Exception as e:
+                        self.fail(batch, e)
+                        await db.rollback()
+                        continue
+
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        except Exception as e:
+            logger.error(f"Запись отзывов остановлена из-за ошибки: {e}")
+            raise
+        finally:
+            # Отзывы, которые уже не будут записаны, завершаем ошибкой, чтобы обработчики не зависли
+            error = RuntimeError("Запись отзывов остановлена")
+            self.fail(batch, error)
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is not None:
+                    self.fail([item], error)
+
+    @staticmethod
+    def fail(batch, error: Exception):
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+
+feedback_writer = FeedbackWriter('feedback.db')
+
+FEEDBACK_PAGE_SIZE = 5
+
+
+def build_feedback_query(text: str) -> str:
+    # В SQLite нет русского стеммера: у длинных слов отбрасываем окончание и ищем по префиксу,
+    # чтобы "ошибки" находило "ошибка" и "ошибок". Если слов нет, возвращается пустая строка
+    terms = []
+    for word in re.findall(r'\w+', text.lower().replace('ё', 'е')):
+        if len(word) > 5:
+            word = word[:-2]
+        terms.append(f'"{word}"*')
+    return ' '.join(terms)
+
+
+async def search_feedback(query: str, page: int):
+    offset = page * FEEDBACK_PAGE_SIZE
+    match = build_feedback_query(query)
+    if query and not match:
+        # В запросе нет ни одного слова (например, только знаки препинания): MATCH '' — синтаксическая ошибка
+        return [], False
+
+    async with aiosqlite.connect('feedback.db') as db:
+        if query:
+            sql = """SELECT f.id, f.user_id, f.timestamp,
+                           snippet(feedback_fts, 0, char(2), char(3), '…', 24)
+                    FROM feedback_fts
+                    JOIN feedback f ON f.id = feedback_fts.rowid
+                    WHERE feedback_fts MATCH ?
+                    ORDER BY rank
+                    LIMIT ? OFFSET ?"""
+            params = (match, FEEDBACK_PAGE_SIZE + 1, offset)
+        else:
+            sql = """SELECT id, user_id, timestamp, substr(feedback, 1, 200)
+                    FROM feedback
+                    ORDER BY id DESC
+                    LIMIT ? OFFSET ?"""
+            params = (FEEDBACK_PAGE_SIZE + 1, offset)
+
+        async with db.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+
+    # Лишняя строка нужна только для того, чтобы понять, есть ли следующая страница
+    return rows[:FEEDBACK_PAGE_SIZE], len(rows) > FEEDBACK_PAGE_SIZE
+
 async def init_db():
     async with aiosqlite.connect('survey.db') as db:
         await db.execute(
@@ -321,7 +961,7 @@ async def process_name(message: Message, state: FSMContext):
 
 @dp.message(F.text == "Начать опрос")
 async def start_survey(message: Message, state: FSMContext):
-    if questions_df is not None:
+    if questions is not None:
         user_id = message.from_user.id
 
         # Создаем инструкцию перед началом опроса
@@ -404,28 +1044,50 @@ async def cmd_analyze_trends(message: Message):
         )
         return
 
-    await analyze_trends_with_gigachat(message.chat.id, user_id)
+    with send_lane(LANE_ANALYSIS):
+        await analyze_trends_with_gigachat(message.chat.id, user_id)
 
 # Обработчик ответов пользователя при опросе
 @dp.callback_query(lambda c: c.data.startswith("rate:"))
 async def process_rating(callback_query: types.CallbackQuery, state: FSMContext):
     user_id = callback_query.from_user.id
+
+    # На каждый вопрос отправляется отдельное сообщение, поэтому принимаем только первый ответ на него:
+    # повторное нажатие или повторная доставка callback не должны повторно считать результат
+    key = (user_id, callback_query.message.message_id)
+    if processed_ratings.seen(key):
+        logger.info(
+            f"Повторный ответ пользователя {user_id} на вопрос пропущен "
+            f"(всего пропущено: {processed_ratings.duplicates})"
+        )
+        await callback_query.answer()
+        return
+
+    # Ключ уже записан: повторные нажатия на это же сообщение вне опроса пропускаются выше без ответа в чат
     if user_id not in user_responses:
+        await callback_query.answer()
         await callback_query.message.answer("Произошла ошибка. Пожалуйста, начните опрос заново.")
         return
 
     rating = int(callback_query.data.split(":")[1])
     user_response = user_responses[user_id]
-    current_question = questions_df.iloc[user_response.current_question]
+    current_question = questions[user_response.current_question]
     user_response.answers[current_question['number']] = rating
     user_response.current_question += 1
 
-    await callback_query.answer()
+    try:
+        await callback_query.answer()
 
-    if user_response.current_question < TOTAL_QUESTIONS:
-        await send_question(callback_query.message.chat.id, user_id)
-    else:
-        await process_results(callback_query.message.chat.id, user_id)
+        if user_response.current_question < TOTAL_QUESTIONS:
+            await send_question(callback_query.message.chat.id, user_id)
+        else:
+            with send_lane(LANE_ANALYSIS):
+                await process_results(callback_query.message.chat.id, user_id)
+    except Exception:
+        # Следующий шаг не выполнен: отменяем ответ, чтобы повторное нажатие на вопрос сработало
+        processed_ratings.forget(key)
+        user_response.current_question -= 1
+        raise
 
 # Обработчик состояния для отправки отзыва
 @dp.message(F.text.in_({"Отправить отзыв"}))
@@ -441,20 +1103,7 @@ async def process_feedback(message: Message, state: FSMContext):
 
     # Попытка сохранить отзыв в базе данных
     try:
-        async with aiosqlite.connect('feedback.db') as db:
-            await db.execute(
-                """CREATE TABLE IF NOT EXISTS feedback (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    feedback TEXT,
-                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )"""
-            )
-            await db.execute(
-                "INSERT INTO feedback (user_id, feedback) VALUES (?, ?)",
-                (user_id, feedback_text)
-            )
-            await db.commit()
+        await feedback_writer.submit(user_id, feedback_text)
 
         await message.answer(
             "Спасибо за ваш отзыв! Мы ценим ваше мнение.",
@@ -471,6 +1120,74 @@ async def process_feedback(message: Message, state: FSMContext):
     # Очищаем состояние после обработки отзыва
     await state.clear()
 
+# Поиск по отзывам для администраторов
+# Запросы хранятся по сообщению с результатами, чтобы кнопки каждого сообщения листали свой поиск
+FEEDBACK_QUERIES_LIMIT = 1000
+feedback_queries: OrderedDict = OrderedDict()
+
+def format_feedback_page(query: str, page: int, rows, has_next: bool):
+    if not rows:
+        return "Отзывы не найдены.", None
+
+    title = f"Поиск по отзывам: {html.escape(query)}" if query else "Последние отзывы"
+    lines = [f"<b>{title}</b> (страница {page + 1})\n"]
+    for feedback_id, user_id, timestamp, text in rows:
+        # Экранируем текст отзыва и только потом выделяем найденные слова
+        text = html.escape(text or '').replace('\x02', '<b>').replace('\x03', '</b>')
+        lines.append(f"#{feedback_id} от {user_id}, {timestamp}\n{text}\n")
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(text="← Назад", callback_data=f"feedback_page:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Далее →", callback_data=f"feedback_page:{page + 1}"))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
+@dp.message(Command("feedback"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_feedback_search(message: Message):
+    query = message.text.partition(' ')[2].strip()
+
+    try:
+        rows, has_next = await search_feedback(query, 0)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске по отзывам: {e}")
+        await message.answer("Произошла ошибка при поиске по отзывам.")
+        return
+
+    text, keyboard = format_feedback_page(query, 0, rows, has_next)
+    result = await message.answer(text, reply_markup=keyboard)
+
+    feedback_queries[(result.chat.id, result.message_id)] = query
+    if len(feedback_queries) > FEEDBACK_QUERIES_LIMIT:
+        feedback_queries.popitem(last=False)
+
+@dp.callback_query(F.data.startswith("feedback_page:"), F.from_user.id.in_(ADMIN_IDS))
+async def process_feedback_page(callback_query: types.CallbackQuery):
+    page = int(callback_query.data.split(":")[1])
+    message = callback_query.message
+    query = feedback_queries.get((message.chat.id, message.message_id))
+    if query is None:
+        await callback_query.answer("Результаты поиска устарели. Повторите команду /feedback.")
+        return
+
+    try:
+        rows, has_next = await search_feedback(query, page)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске по отзывам: {e}")
+        await callback_query.answer("Произошла ошибка при поиске по отзывам.")
+        return
+
+    # Отвечаем до редактирования, чтобы кнопка не зависла, если редактирование не удастся
+    await callback_query.answer()
+    text, keyboard = format_feedback_page(query, page, rows, has_next)
+    try:
+        await callback_query.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Двойное нажатие: сообщение уже показывает эту страницу
+        if "message is not modified" not in str(e):
+            raise
+
 @dp.message()
 async def handle_invalid_input(message: Message, state: FSMContext):
     current_state = await state.get_state()
@@ -484,7 +1201,7 @@ async def handle_invalid_input(message: Message, state: FSMContext):
 async def send_question(chat_id: int, user_id: int):
     user_response = user_responses[user_id]
     if user_response.current_question < TOTAL_QUESTIONS:
-        question = questions_df.iloc[user_response.current_question]
+        question = questions[user_response.current_question]
         await bot.send_message(
             chat_id=chat_id,
             text=f"Вопрос {user_response.current_question + 1} из {TOTAL_QUESTIONS}\n\n"
@@ -494,6 +1211,11 @@ async def send_question(chat_id: int, user_id: int):
 
 # Анализ результатов единичного заполнения опросника
 async def analyze_results_with_gigachat(well_being: float, activity: float, mood: float) -> str:
+    # Модули уже загружены в get_llm, поэтому импорт ниже не блокирует цикл событий
+    llm = await get_llm()
+    from langchain.chains import LLMChain
+    from langchain.prompts import PromptTemplate
+
     prompt = PromptTemplate(
         input_variables=["well_being", "activity", "mood"],
         template="""Ты - опытный психолог-аналитик, специализирующийся на оценке психоэмоционального состояния. Используй следующие данные опросника САН:
@@ -527,10 +1249,7 @@ async def analyze_results_with_gigachat(well_being: float, activity: float, mood
         **Не используй в своем ответе форматирование markdown**, для визуального разделения секций сообщения лучше использовать подходящие по контексту эмодзи."""
     )
 
-    chain = LLMChain(
-        llm=LangChainGigaChat(credentials=GIGACHAT_CREDENTIALS, verify_ssl_certs=False),
-        prompt=prompt
-    )
+    chain = LLMChain(llm=llm, prompt=prompt)
 
     result = await chain.arun({
         "well_being": well_being,
@@ -650,6 +1369,10 @@ async def analyze_trends_with_gigachat(chat_id: int, user_id: int, num_last_resu
                 f"Настроение: {mood:.1f}\n"
             )
 
+        llm = await get_llm()
+        from langchain.chains import LLMChain
+        from langchain.prompts import PromptTemplate
+
         # Создаем промпт для GigaChat
         prompt = PromptTemplate(
             input_variables=["measurements"],
@@ -675,21 +1398,7 @@ async def analyze_trends_with_gigachat(chat_id: int, user_id: int, num_last_resu
             При этом не пиши никаких приветственных сообщений или введений, переходи сразу к сути."""
         )
 
-        # Получаем анализ от GigaChat
-        chain = LLMChain(
-            llm=LangChainGigaChat(credentials=GIGACHAT_CREDENTIALS, verify_ssl_certs=False),
-            prompt=prompt
-        )
-
-        analysis = await chain.arun({
-            "measurements": "\n---\n".join(formatted_data)
-        })
-
-        # Отправляем результат анализа
-        await bot.send_message(
-            chat_id=chat_id,
-            text=f"Анализ динамики показателей САН за последние {len(results)} измерений:\n\n{analysis}"
-        )
+        chain = LLMChain(llm=llm, prompt=prompt)
 
     except Exception as e:
         logger.error(f"Ошибка при анализе трендов: {e}")
@@ -697,6 +1406,31 @@ async def analyze_trends_with_gigachat(chat_id: int, user_id: int, num_last_resu
             chat_id=chat_id,
             text="Произошла ошибка при анализе трендов. Пожалуйста, попробуйте позже."
         )
+        return
+
+    # Анализ и отправку ответа (или сообщения об ошибке) выполняет одна общая задача для всех
+    # одинаковых запросов: пользователь получит ровно одно сообщение, даже если кто-то из ожидающих отменен
+    async def analyze_and_send():
+        try:
+            # Получаем анализ от GigaChat
+            analysis = await chain.arun({
+                "measurements": "\n---\n".join(formatted_data)
+            })
+
+            # Отправляем результат анализа
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"Анализ динамики показателей САН за последние {len(results)} измерений:\n\n{analysis}"
+            )
+
+        except Exception as e:
+            logger.error(f"Ошибка при анализе трендов: {e}")
+            await bot.send_message(
+                chat_id=chat_id,
+                text="Произошла ошибка при анализе трендов. Пожалуйста, попробуйте позже."
+            )
+
+    await llm_flight.run((user_id, 'trends', tuple(results)), analyze_and_send)
 
 
 # Отправка напоминаний всем зарегистрированным пользователям
@@ -724,11 +1458,12 @@ async def send_reminder():
                 else:
                     message_text = f"{name}, пришло время снова пройти опрос САН!"
 
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    reply_markup=main_menu
-                )
+                with send_lane(LANE_REMINDER):
+                    await bot.send_message(
+                        chat_id=user_id,
+                        text=message_text,
+                        reply_markup=main_menu
+                    )
                 logger.info(f"Отправлено напоминание пользователю {user_id}")
 
             except Exception as e:
@@ -745,19 +1480,43 @@ async def main():
     await create_user_database()
     await init_db()
     await create_feedback_database()
+    feedback_writer.start()
+    startup_profiler.mark("создание баз данных")
+
+    # Все исходящие запросы к Telegram проходят через общую очередь
+    bot.session.middleware(outbound)
 
     # Регистрируем middleware
+    # Анти-флуд подключаем как outer middleware, чтобы отбрасывать события до фильтров и обработчиков
+    throttling = create_throttling_middleware()
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
     dp.message.middleware.register(RegistrationMiddleware())
     dp.message.middleware.register(LoggingMiddleware())
 
     # Настраиваем периодическое напоминание
     reminder_interval = int(os.getenv('REMINDER_INTERVAL', '60'))
     scheduler.add_job(send_reminder, 'interval', minutes=reminder_interval)
+    scheduler.add_job(outbound.log_stats, 'interval', minutes=10)
     scheduler.start()
 
+    if startup_profiler.enabled:
+        dp.startup.register(startup_profiler.on_startup)
+        dp.update.outer_middleware(startup_profiler.first_update_middleware)
+    startup_profiler.mark("настройка middleware и планировщика")
+
     # Запускаем бота
     await set_commands()
-    await dp.start_polling(bot)
+    startup_profiler.mark("установка команд")
+
+    # Модули GigaChat подгружаются в отдельном потоке параллельно с запуском опроса обновлений
+    warm_up = asyncio.create_task(warm_up_llm())
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # Дописываем отзывы, оставшиеся в очереди
+        await feedback_writer.close()
+    await warm_up
 
 
 if __name__ == "__main__":